@@ -1,23 +1,45 @@
 import argparse
+import logging
 from setmeup.config import YamlConfig
-from setmeup.plan import Plan, DEFAULT_PLAN_FILE_NAME
+from setmeup.plan import Plan, DEFAULT_PLAN_FILE_NAME, JSON_PLAN_FILE_EXTENSION
+from setmeup.utils import log_hash_backend
 
+log = logging.getLogger(__name__)
 
-def handle_plan_command(config_file, plan_file):
-    config = YamlConfig(config_file)
-    plan = config.plan()
+
+def handle_plan_command(config_file, plan_file) -> Plan:
+    # Skip parsing and hashing all configs if none of the files the existing plan was generated from changed
+    plan = Plan.load_if_up_to_date(config_file, plan_file)
+    if plan is None:
+        config = YamlConfig.load(config_file)
+        plan = config.plan()
+        plan.save_to_file(plan_file)
 
     plan.visualize()
-    filename = plan.save_to_file(plan_file)
-    return filename
+    return plan
 
 
 def handle_apply_command(plan_file):
-    plan = Plan.load_from_file(plan_file)
+    plan = None
+    if plan_file.endswith(JSON_PLAN_FILE_EXTENSION):
+        # JSON plans can only be read as a whole, so the version is checked after loading the plan
+        plan = Plan.load_from_file(plan_file)
+        plan_version = plan.setmeup_version
+    else:
+        # Bail out before parsing the whole plan if it was generated by an incompatible version
+        plan_version = Plan.peek_version(plan_file)
+    if plan_version is not None and plan_version != Plan.setmeup_version:
+        log.error('🔴 %s has version %s but version %s is required. You need to re-run the plan command.', plan_file, plan_version, Plan.setmeup_version)
+        return
+
+    if plan is None:
+        plan = Plan.load_from_file(plan_file)
     plan.apply()
 
 
 def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
     parser = argparse.ArgumentParser(
         description='SetMeUp Tool: Automate your system setup with YAML configurations.',
         epilog='Example: setmeup plan -c config.yaml -p plan.yaml'
@@ -39,13 +61,16 @@ def main():
         parser.print_help()
         return
 
+    log_hash_backend()
+
     if args.command == 'plan':
-        plan_file = handle_plan_command(args.config, args.plan)
+        plan = handle_plan_command(args.config, args.plan)
 
         # Prompt the user to apply the plan immediately
         apply_now = input("❓ Do you want to apply the plan now? (yes/no): ").strip().lower()
         if apply_now in ['yes', 'y']:
-            handle_apply_command(plan_file)
+            # The plan is still in memory, so there is no need to load it from the file again
+            plan.apply()
 
     if args.command == 'apply':
         handle_apply_command(args.plan)
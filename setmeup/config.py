@@ -1,11 +1,11 @@
-import logging
 import os
-import yaml
-from typing import List, Optional, Set
-from setmeup.utils import check_if_step_ran, checksum_from_file, checksum_from_string, get_file_content_or_command, is_file
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+from setmeup.utils import check_if_step_ran, checksum_from_file, checksum_from_string, fingerprint_files, is_file, yaml_load
 from setmeup.plan import Plan, PlanStep, PlanStepChecksum, PlanEnvironmentVariable
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+if TYPE_CHECKING:
+    from concurrent.futures import Future
 
 ENV_VARS_KEY = 'env_vars'
 INHERITS_KEY = 'inherits'
@@ -30,9 +30,6 @@ class EnvironmentVariable:
         self.store_in = store_in
         self.value = value
 
-    def __hash__(self) -> int:
-        return int(hash(self.name))
-
     def to_plan_format_v1(self):
         return PlanEnvironmentVariable(
             description=self.description,
@@ -42,28 +39,59 @@ class EnvironmentVariable:
         )
 
 class SetupStep:
+    __slots__ = ('name', 'description', 'completion_check', 'env_vars', '_checksum', '_plan_step')
+
     name: str
     description: Optional[str]
     completion_check: Optional[str]
     env_vars: List[EnvironmentVariable]
-    _checksum: str
+    _checksum: Optional[str]
     _type: str
+    _plan_step: Optional[PlanStep]
 
     def __init__(self, description: Optional[str] = None, completion_check: Optional[str] = None, env_vars: Optional[List[dict]] = None) -> None:
         env_vars = env_vars or []
         self.description = description
         self.completion_check = completion_check
         self.env_vars = [EnvironmentVariable(**var) for var in env_vars]
-        self._checksum = self.checksum()
+        # Computed on first access of checksum_value
+        self._checksum = None
+        self._plan_step = None
 
     def checksum(self):
         raise NotImplementedError
 
-    def to_plan_format_v1(self):
+    @property
+    def checksum_value(self) -> str:
+        if self._checksum is None:
+            self._checksum = self.checksum()
+        return self._checksum
+
+    def input_file(self) -> Optional[str]:
+        """ The file the step depends on, if any. """
+        return None
+
+    def target(self) -> str:
+        """ The Brewfile or script the step executes. """
+        raise NotImplementedError
+
+    def identity(self) -> Tuple[str, str, Optional[str], Tuple[str, ...]]:
+        """ Steps with the same identity are defined identically and perform the same work. """
+        return self._type, self.target(), self.completion_check, tuple(var.name for var in self.env_vars)
+
+    def to_plan_format_v1(self) -> PlanStep:
+        # Building the plan step runs the validation command, so it is only done once per step
+        if self._plan_step is None:
+            self._plan_step = self.build_plan_step_v1()
+        return self._plan_step
+
+    def build_plan_step_v1(self) -> PlanStep:
         raise NotImplementedError
 
 
 class BrewfileSetupStep(SetupStep):
+    __slots__ = ('brewfile',)
+
     brewfile: str
     name = 'Install Brew Bundle'
     _type = 'brewfile'
@@ -75,13 +103,19 @@ class BrewfileSetupStep(SetupStep):
     def checksum(self) -> str:
         return checksum_from_file(self.brewfile)
 
-    def to_plan_format_v1(self):
+    def input_file(self) -> Optional[str]:
+        return self.brewfile
+
+    def target(self) -> str:
+        return os.path.realpath(self.brewfile)
+
+    def build_plan_step_v1(self) -> PlanStep:
         validation_command = f'brew bundle check --file {self.brewfile} --verbose'
         return PlanStep(
             name=self.name,
             description=self.description,
             checksum={
-                'value': self._checksum,
+                'value': self.checksum_value,
                 'origin': self.brewfile,
                 'checksum_type': PlanStepChecksum.TYPE_FILE
             },
@@ -93,7 +127,10 @@ class BrewfileSetupStep(SetupStep):
 
 
 class ScriptSetupStep(SetupStep):
+    __slots__ = ('script', '_is_file')
+
     script: str
+    _is_file: bool
     _type = 'script'
 
     def __init__(
@@ -104,18 +141,23 @@ class ScriptSetupStep(SetupStep):
     ) -> None:
         self.script = script
         self.name = f'Execute Script {script}'
+        self._is_file = is_file(script)
         super().__init__(*args, **kwargs)
 
-    def get_script_content(self) -> str:
-        return get_file_content_or_command(self.script)
-
     def checksum(self) -> str:
-        script_content = self.get_script_content()
+        if self._is_file:
+            return checksum_from_file(self.script)
         # Generate SHA256 checksum
-        return checksum_from_string(script_content)
+        return checksum_from_string(self.script)
 
-    def to_plan_format_v1(self):
-        if is_file(self.script):
+    def input_file(self) -> Optional[str]:
+        return self.script if self._is_file else None
+
+    def target(self) -> str:
+        return os.path.realpath(self.script) if self._is_file else self.script
+
+    def build_plan_step_v1(self) -> PlanStep:
+        if self._is_file:
             execute_command = f'/bin/bash {self.script}'
             checksum_type = PlanStepChecksum.TYPE_FILE
         else:
@@ -128,7 +170,7 @@ class ScriptSetupStep(SetupStep):
             name=self.name,
             description=self.description,
             checksum={
-                'value': self._checksum,
+                'value': self.checksum_value,
                 'origin': self.script,
                 'checksum_type': checksum_type
             },
@@ -141,57 +183,155 @@ class ScriptSetupStep(SetupStep):
 
 class YamlConfig:
     inherits: List[str]
-    env_vars: Set[EnvironmentVariable]
+    env_vars: Dict[str, EnvironmentVariable]
     steps: List[SetupStep]
+    config_files: List[str]
+    _base_path: str
+    _realpath: str
+
+    # Configs that were loaded or are being loaded (keyed by their real path) so shared ancestors are only parsed once.
+    # Entries are kept for the whole process until clear_cache() is called
+    _cache: Dict[str, 'Future[YamlConfig]'] = {}
+    # The configs each config that is still resolving its inherited configs requested so far, used to detect inheritance cycles
+    _loading: Dict[str, Set[str]] = {}
+    # Inherited configs are loaded from several threads
+    _cache_lock = threading.Lock()
 
     def __init__(self, filepath):
         self.filepath = filepath
+        self._base_path = os.path.dirname(filepath)  # Base directory of the YAML file
+        self._realpath = os.path.realpath(filepath)
         self.load_yaml()
 
+    @classmethod
+    def load(cls, filepath: str, inherited_by: Optional[str] = None) -> 'YamlConfig':
+        """ Load a config, reusing it if it was already loaded before or waiting for it if another thread is loading it.
+
+        Loaded configs (and the plan steps built from them) are reused until clear_cache() is called, even if the files changed.
+        """
+        from concurrent.futures import Future
+        realpath = os.path.realpath(filepath)
+        with cls._cache_lock:
+            if inherited_by is not None:
+                # Waiting for a config that (indirectly) waits for the inheriting config itself would never finish
+                if cls._inherits(realpath, inherited_by):
+                    raise Exception(f"Circular inheritance detected for config '{filepath}'")
+                cls._loading[inherited_by].add(realpath)
+            future = cls._cache.get(realpath)
+            is_loader = future is None
+            if is_loader:
+                future = cls._cache[realpath] = Future()
+
+        if is_loader:
+            try:
+                future.set_result(cls(filepath))
+            except Exception as e:
+                future.set_exception(e)
+                # Threads already waiting for the config get the error, later loads try again
+                with cls._cache_lock:
+                    if cls._cache.get(realpath) is future:
+                        del cls._cache[realpath]
+        return future.result()
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """ Forget all loaded configs, so the next load reads the config files again. """
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    @classmethod
+    def _inherits(cls, realpath: str, other_realpath: str) -> bool:
+        """ Whether a config (indirectly) requested other_realpath while resolving its inherited configs. Requires _cache_lock. """
+        visited = set()
+        to_visit = [realpath]
+        while to_visit:
+            path = to_visit.pop()
+            if path == other_realpath:
+                return True
+            if path not in visited:
+                visited.add(path)
+                to_visit.extend(cls._loading.get(path, ()))
+        return False
+
     def load_yaml(self):
-        with open(self.filepath, 'r') as file:
-            config = yaml.safe_load(file)
+        with open(self.filepath, 'rb') as file:
+            config = yaml_load(file.read())
         self.inherits = config.get(INHERITS_KEY, [])
-        self.env_vars = {EnvironmentVariable(**var) for var in config.get(ENV_VARS_KEY, [])}
+        self.config_files = [self._realpath]
+        self.env_vars = {var['name']: EnvironmentVariable(**var) for var in config.get(ENV_VARS_KEY, [])}
         self.steps = self.parse_steps(config)
         self.parse_inherited_configs()
 
     def parse_steps(self, config) -> List[SetupStep]:
         steps = []
-        base_path = os.path.dirname(self.filepath)  # Base directory of the YAML file
-
         for step in config.get('steps', []):
             if step.get(BREWFILE_KEY):
                 steps.append(BrewfileSetupStep(**step))
             elif step.get(SCRIPT_KEY):
                 # Check if script is a path and resolve its relative path
                 script = step[SCRIPT_KEY]
-                is_file = os.path.isfile(os.path.join(base_path, script))
-                step[SCRIPT_KEY] = os.path.join(base_path, script) if is_file else script
+                script_path = os.path.join(self._base_path, script)
+                step[SCRIPT_KEY] = script_path if is_file(script_path) else script
                 steps.append(ScriptSetupStep(**step))
         return steps
 
     def parse_inherited_configs(self):
         """ Recursively load inherited configurations. """
-        new_env_vars = set()
-        new_steps = []
-        for relative_path in self.inherits:
-            base_path = os.path.dirname(self.filepath)
-            absolute_path = os.path.join(base_path, relative_path)
-
-            inherited_config = YamlConfig(absolute_path)
-            inherited_config.parse_inherited_configs()
+        absolute_paths = [os.path.join(self._base_path, relative_path) for relative_path in self.inherits]
+        with YamlConfig._cache_lock:
+            YamlConfig._loading[self._realpath] = set()
+        try:
+            # Inherited configs of the inherited config are already resolved while loading it
+            if len(absolute_paths) > 1:
+                from concurrent.futures import ThreadPoolExecutor
+                # Overlap reading and parsing the inherited configs
+                with ThreadPoolExecutor() as executor:
+                    inherited_configs = list(executor.map(lambda path: YamlConfig.load(path, self._realpath), absolute_paths))
+            else:
+                inherited_configs = [YamlConfig.load(path, self._realpath) for path in absolute_paths]
+        finally:
+            with YamlConfig._cache_lock:
+                del YamlConfig._loading[self._realpath]
+
+        new_env_vars = {}
+        # Merge in the order the configs are inherited
+        for inherited_config in inherited_configs:
             new_env_vars.update(inherited_config.env_vars)
-            new_steps += inherited_config.steps
+            self.config_files += inherited_config.config_files
 
         # self.env_vars overwrites inherited env vars
         new_env_vars.update(self.env_vars)
         self.env_vars = new_env_vars
         # Inherited steps are performed in the order the are specified prior to self.steps
-        self.steps = new_steps + self.steps
+        self.steps = self.deduplicate_steps([inherited_config.steps for inherited_config in inherited_configs] + [self.steps])
+
+    @staticmethod
+    def deduplicate_steps(step_lists: List[List[SetupStep]]) -> List[SetupStep]:
+        """ Concatenate the steps of several configs, dropping steps an earlier config defines identically (e.g. the same Brewfile in several inherited configs). """
+        seen = set()
+        deduplicated_steps = []
+        for steps in step_lists:
+            identities = [step.identity() for step in steps]
+            deduplicated_steps += [step for step, identity in zip(steps, identities) if identity not in seen]
+            # Repeated steps within a single config are deliberate, so they are kept
+            seen.update(identities)
+        return deduplicated_steps
+
+    def input_files(self) -> List[str]:
+        """ All files the plan depends on, starting with this config file. """
+        step_files = [step.input_file() for step in self.steps]
+        input_files = self.config_files + [os.path.realpath(file) for file in step_files if file]
+        return list(dict.fromkeys(input_files))
 
     def plan(self) -> 'Plan':
+        from concurrent.futures import ThreadPoolExecutor
+        # Reading and hashing files releases the GIL, so the checksums of all steps are computed concurrently
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(lambda step: step.checksum_value, self.steps))
+
         plan = Plan()
-        plan.required_env_vars = [var.to_plan_format_v1() for var in self.env_vars]
+        plan.required_env_vars = [var.to_plan_format_v1() for var in self.env_vars.values()]
         plan.steps_to_execute = [step.to_plan_format_v1() for step in self.steps]
+        plan.input_files = self.input_files()
+        plan.fingerprint = fingerprint_files(plan.input_files)
         return plan
@@ -1,18 +1,49 @@
-from setmeup.utils import check_if_step_ran, checksum_from_file, checksum_from_string
+from setmeup.utils import check_if_step_ran, check_if_steps_ran, checksum_from_file, checksum_from_string, fingerprint_files, yaml_add_representer, yaml_dump, yaml_dump_sequence, yaml_load
 import logging
 import os
-import yaml
-import subprocess
-from datetime import datetime
-from typing import List, Optional
-from textwrap import dedent
+import re
+import shlex
+import shutil
+import functools
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+if TYPE_CHECKING:
+    from datetime import datetime
+
+log = logging.getLogger(__name__)
 
 
 DEFAULT_PLAN_FILE_NAME = 'setmeup_plan.yaml'
+FINGERPRINT_HEADER = '# setmeup-fingerprint: '
+INPUT_FILES_HEADER = '# setmeup-inputs: '
+JSON_PLAN_FILE_EXTENSION = '.json'
+# Maximum number of shells running validation commands concurrently
+MAX_VALIDATION_SHELLS = 4
+VERSION_PATTERN = re.compile(r'''^setmeup_version:\s*['"]?([\d.]+)''')
+
+PLAN_VISUALIZATION_TEMPLATE = """
+🚧 Execution Plan 🚧
+
+## The following env variables will be stored
+
+{env_vars}
+
+## The following steps will be executed
+
+{steps_to_execute}
+
+## The following steps will be skipped
+
+{skipped_steps}
+"""
+
+# Commands containing any of these characters need a shell to be interpreted correctly
+SHELL_SYNTAX_PATTERN = re.compile(r'[|&;<>$`\\(){}\[\]*?~#!=\n]')
 
 class PlanEnvironmentVariable:
+    __slots__ = ('name', 'description', 'store_in', 'value')
+    YAML_FIELDS = ('name', 'description', 'store_in', 'value')
+
     name: str
     description: Optional[str]
     store_in: Optional[str]
@@ -29,7 +60,6 @@ class PlanEnvironmentVariable:
         self.description = description
         self.store_in = store_in
         self.value = value
-        self.logger = logging.getLogger(__name__)
 
     def to_dict(self):
         return {
@@ -39,51 +69,71 @@ class PlanEnvironmentVariable:
             'value': self.value
         }
 
-    def apply(self):
+    def get_value(self):
         value = self.value
         if value is None:
             value = input(f"Enter a value for {self.name} ({self.description}): ")
-        self.set_value(value)
-        self.store_value(value)
+        return value
 
     def set_value(self, value):
         if os.environ.get(self.name):
-            self.logger.info(f'✅ Env variable {self.name} already set in environment')
+            log.info('✅ Env variable %s already set in environment', self.name)
             return
         os.environ[self.name] = value
-        self.logger.info(f'✅ Set env variable {self.name} in environment')
-
-
-    def store_value(self, value):
-        env_var_set_string = f'{self.name}="{value}"'
-        file_updated = False
-
-        if self.store_in:
-            file_path = os.path.expanduser(self.store_in)
-            lines = []
-            if os.path.isfile(file_path):
-                # Read the file and store the lines
-                with open(file_path, 'r') as file:
-                    lines = file.readlines()
-            # Check and update the environment variable
-            with open(file_path, 'w+') as file:
-                for line in lines:
-                    if line.strip().startswith(f'export {self.name}='):
-                        # Update the existing variable
-                        file.write(f'export {env_var_set_string}\n')
-                        file_updated = True
-                        self.logger.info(f'✅ Updated existing env variable {self.name} to {self.store_in}')
-                    else:
-                        # Write the line as it is
-                        file.write(line)
-
-                # If the variable was not found, append it
-                if not file_updated:
-                    file.write(f'\nexport {env_var_set_string}\n')
-                    self.logger.info(f'✅ Wrote env variable {self.name} to {self.store_in}')
+        log.info('✅ Set env variable %s in environment', self.name)
+
+
+def store_env_var_values(store_in: str, values: List[Tuple[str, str]]) -> None:
+    """ Export the (name, value) pairs in the store_in file, rewriting the file only once. """
+    # Resolve symlinks (e.g. dotfiles managed in a repository) so the link itself is not replaced
+    file_path = os.path.realpath(os.path.expanduser(store_in))
+    try:
+        with open(file_path, 'r') as file:
+            content = file.read()
+    except FileNotFoundError:
+        content = ''
+
+    for name, value in values:
+        env_var_set_string = f'{name}="{value}"'
+        # Update the existing variable
+        export_pattern = re.compile(rf'^[ \t]*export {re.escape(name)}=.*$', re.MULTILINE)
+        content, updated_lines = export_pattern.subn(lambda _: f'export {env_var_set_string}', content)
+        if updated_lines:
+            log.info('✅ Updated existing env variable %s to %s', name, store_in)
+        else:
+            # If the variable was not found, append it
+            content = content.rstrip() + f'\nexport {env_var_set_string}\n'
+            log.info('✅ Wrote env variable %s to %s', name, store_in)
+
+    # Write to a temporary file first so the file is never left half written
+    tmp_file_path = f'{file_path}.tmp'
+    with open(tmp_file_path, 'w') as file:
+        file.write(content)
+    try:
+        shutil.copymode(file_path, tmp_file_path)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_file_path, file_path)
+
+
+def apply_env_vars(env_vars: List[PlanEnvironmentVariable]) -> None:
+    """ Set the env variables and store them, writing every target file once for all of its variables. """
+    # Prompts stay sequential since they need the terminal
+    values_by_file: Dict[str, List[Tuple[str, str]]] = {}
+    for env_var in env_vars:
+        value = env_var.get_value()
+        env_var.set_value(value)
+        if env_var.store_in:
+            values_by_file.setdefault(env_var.store_in, []).append((env_var.name, value))
+
+    for store_in, values in values_by_file.items():
+        store_env_var_values(store_in, values)
 
 
 class PlanStepChecksum:
+    __slots__ = ('value', 'origin', 'checksum_type')
+    YAML_FIELDS = ('value', 'origin', 'checksum_type')
+
     value: str
     origin: str
     checksum_type: str
@@ -113,14 +163,18 @@ class PlanStepChecksum:
 
 
 class PlanStep:
+    __slots__ = ('name', 'description', 'checksum', 'execute', 'validation', 'executed_at', 'skip', 'env_vars', 'plan_string', '_argv')
+    YAML_FIELDS = ('name', 'description', 'checksum', 'execute', 'validation', 'skip', 'env_vars')
+
     name: str
     description: Optional[str]
     checksum: PlanStepChecksum
     execute: str
     validation: Optional[str]
-    executed_at: Optional[datetime]
+    executed_at: Optional['datetime']
     skip: bool
     env_vars: List[PlanEnvironmentVariable]
+    plan_string: str
 
     def __init__(
             self,
@@ -129,7 +183,7 @@ class PlanStep:
             execute: str,
             validation: Optional[str] = None,
             description:  Optional[str] = None,
-            executed_at: Optional[datetime] = None,
+            executed_at: Optional['datetime'] = None,
             env_vars: Optional[List[PlanEnvironmentVariable]] = None,
             skip: Optional[bool] = False
         ) -> None:
@@ -141,6 +195,27 @@ class PlanStep:
         self.executed_at = executed_at
         self.skip = skip or False
         self.env_vars = env_vars or []
+        # Simple commands can be executed directly, which saves spawning a shell
+        self._argv = None if SHELL_SYNTAX_PATTERN.search(execute) else self._split_command(execute)
+        self.plan_string = self._build_plan_string()
+
+    @staticmethod
+    def _split_command(command: str) -> Optional[List[str]]:
+        try:
+            return shlex.split(command)
+        except ValueError:
+            # e.g. unbalanced quotes, the shell reports the error when the step is run
+            return None
+
+    def _build_plan_string(self) -> str:
+        if self.skip:
+            return f"⏩ {self.description}:\n  [SKIP] {self.execute}"
+        else:
+            return f"👉 {self.description}:\n  [RUN] {self.execute}"
+
+    def set_skip(self, skip: Optional[bool]) -> None:
+        self.skip = skip or False
+        self.plan_string = self._build_plan_string()
 
     def to_dict(self):
         return {
@@ -153,26 +228,37 @@ class PlanStep:
             'env_vars': [var.to_dict() for var in self.env_vars],
         }
 
-    @property
-    def plan_string(self):
-        if self.skip:
-            return f"⏩ {self.description}:\n  [SKIP] {self.execute}"
-        else:
-            return f"👉 {self.description}:\n  [RUN] {self.execute}"
-
     def check_if_ran(self):
         return check_if_step_ran(self.validation)
 
     def run(self):
-        for env_var in self.env_vars:
-            env_var.apply()
-        subprocess.run([self.execute], check=True, shell=True)
+        import subprocess
+        apply_env_vars(self.env_vars)
+        # Shell builtins (e.g. cd or source) and commands that are not installed yet still go through the shell
+        if self._argv and shutil.which(self._argv[0]):
+            subprocess.run(self._argv, check=True)
+        else:
+            subprocess.run([self.execute], check=True, shell=True)
+
+
+def _represent_plan_object(dumper, plan_object):
+    fields = [(field, getattr(plan_object, field)) for field in plan_object.YAML_FIELDS]
+    return dumper.represent_mapping('tag:yaml.org,2002:map', fields)
+
+
+@functools.lru_cache(maxsize=None)
+def _register_yaml_representers() -> None:
+    # Lets the dumper walk the plan objects directly instead of converting them with to_dict() first
+    for plan_class in (PlanEnvironmentVariable, PlanStepChecksum, PlanStep):
+        yaml_add_representer(plan_class, _represent_plan_object)
 
 
 class Plan:
     setmeup_version: str = '1.0'
     required_env_vars: List[PlanEnvironmentVariable]
     steps_to_execute: List[PlanStep]
+    fingerprint: Optional[str]
+    input_files: List[str]
     _filename: str = DEFAULT_PLAN_FILE_NAME
 
     def __init__(
@@ -180,23 +266,108 @@ class Plan:
             setmeup_version: Optional[str] = None,
             required_env_vars: Optional[List[PlanEnvironmentVariable]] = None,
             steps_to_execute: Optional[List[PlanStep]] = None,
-            filename: Optional[str] = None
+            filename: Optional[str] = None,
+            fingerprint: Optional[str] = None,
+            input_files: Optional[List[str]] = None,
         ) -> None:
         if setmeup_version:
             self.setmeup_version = setmeup_version
         self.required_env_vars = required_env_vars or []
         self.steps_to_execute = steps_to_execute or []
         self._filename = filename or DEFAULT_PLAN_FILE_NAME
-        self.logger = logging.getLogger(__name__)
+        self.fingerprint = fingerprint
+        self.input_files = input_files or []
 
     def __repr__(self) -> str:
         return self.visualize()
 
+    @staticmethod
+    def _parse_header(fingerprint_line: str, input_files_line: str) -> Tuple[Optional[str], List[str]]:
+        import json
+        if not fingerprint_line.startswith(FINGERPRINT_HEADER) or not input_files_line.startswith(INPUT_FILES_HEADER):
+            return None, []
+        return fingerprint_line[len(FINGERPRINT_HEADER):].strip(), json.loads(input_files_line[len(INPUT_FILES_HEADER):])
+
     @classmethod
-    def load_from_file(cls, filename: str = DEFAULT_PLAN_FILE_NAME):
-        with open(filename, 'r') as file:
-            plan = yaml.safe_load(file)
+    def read_fingerprint(cls, filename: str = DEFAULT_PLAN_FILE_NAME) -> Tuple[Optional[str], List[str]]:
+        """ Read the fingerprint and input files from the header comments of a YAML plan without parsing the whole plan. """
+        try:
+            with open(filename, 'r') as file:
+                fingerprint_line = file.readline()
+                input_files_line = file.readline()
+        except FileNotFoundError:
+            return None, []
+        return cls._parse_header(fingerprint_line, input_files_line)
+
+    @staticmethod
+    def peek_version(filename: str = DEFAULT_PLAN_FILE_NAME) -> Optional[str]:
+        """ Read the version of a YAML plan file without parsing the whole plan. """
+        try:
+            with open(filename, 'r') as file:
+                for line in file:
+                    # The version is the first key after the header comments
+                    if line.startswith('#'):
+                        continue
+                    match = VERSION_PATTERN.match(line)
+                    return match.group(1) if match else None
+        except FileNotFoundError:
+            pass
+        return None
+
+    @classmethod
+    def load_if_up_to_date(cls, config_file: str, filename: str = DEFAULT_PLAN_FILE_NAME) -> Optional['Plan']:
+        """ Load an existing plan if it was generated from config_file and none of its input files changed since. """
+        import yaml
+        try:
+            plan_data = None
+            if filename.endswith(JSON_PLAN_FILE_EXTENSION):
+                # JSON plans can only be read as a whole, so the plan is parsed once and reused below
+                try:
+                    plan_data = cls._read_plan_data(filename)
+                except FileNotFoundError:
+                    return None
+                fingerprint, input_files = plan_data.get('fingerprint'), plan_data.get('input_files', [])
+            else:
+                fingerprint, input_files = cls.read_fingerprint(filename)
+
+            if not input_files or input_files[0] != os.path.realpath(config_file):
+                return None
+            version = plan_data.get('setmeup_version') if plan_data is not None else cls.peek_version(filename)
+            if version != cls.setmeup_version:
+                return None
+            if fingerprint_files(input_files) != fingerprint:
+                return None
+
+            plan = cls._from_data(plan_data, filename) if plan_data is not None else cls.load_from_file(filename)
+        except (yaml.YAMLError, ValueError, KeyError, TypeError):
+            # e.g. the plan file was cut off, it is generated again
+            log.warning('⚠️ Could not read %s, generating a new plan', filename)
+            return None
+
+        log.info('✅ No config changed since %s was generated, reusing it', filename)
+        # Steps could have been completed since the plan was generated
+        already_ran = cls._batch_validate([step.validation for step in plan.steps_to_execute])
+        for step, ran in zip(plan.steps_to_execute, already_ran):
+            step.set_skip(ran)
+        return plan
+
+    @classmethod
+    def _read_plan_data(cls, filename: str) -> dict:
+        """ Parse a plan file, including the fingerprint and input files of its header. """
+        if filename.endswith(JSON_PLAN_FILE_EXTENSION):
+            import json
+            with open(filename, 'r') as file:
+                return json.load(file)
+
+        with open(filename, 'rb') as file:
+            content = file.read()
+        plan = yaml_load(content)
+        fingerprint_line, input_files_line = (content.split(b'\n', 2) + [b''])[:2]
+        plan['fingerprint'], plan['input_files'] = cls._parse_header(fingerprint_line.decode(), input_files_line.decode())
+        return plan
 
+    @classmethod
+    def _from_data(cls, plan: dict, filename: str) -> 'Plan':
         # Instantiate PlanEnvironmentVariable objects
         for step in plan['steps_to_execute']:
             step['env_vars'] = [PlanEnvironmentVariable(**var) for var in step['env_vars']]
@@ -205,94 +376,133 @@ class Plan:
             setmeup_version=plan['setmeup_version'],
             required_env_vars=[PlanEnvironmentVariable(**var) for var in plan['required_env_vars']],
             steps_to_execute=[PlanStep(**step) for step in plan['steps_to_execute']],
-            filename=filename
+            filename=filename,
+            fingerprint=plan.get('fingerprint'),
+            input_files=plan.get('input_files'),
         )
 
+    @classmethod
+    def load_from_file(cls, filename: str = DEFAULT_PLAN_FILE_NAME):
+        return cls._from_data(cls._read_plan_data(filename), filename)
+
     def visualize(self):
         env_vars_string = '\n'.join(f"👉 {var.name} will be stored in {var.store_in}" for var in self.required_env_vars if var.store_in)
         steps_to_execute = []
         skipped_steps = []
         for step in self.steps_to_execute:
-            if step.skip:
-                skipped_steps.append(step.plan_string)
-            else:
-                steps_to_execute.append(step.plan_string)
-
-        msg = dedent("""
-        🚧 Execution Plan 🚧
+            (skipped_steps if step.skip else steps_to_execute).append(step.plan_string)
 
-        ## The following env variables will be stored
-
-        {env_vars}
-
-        ## The following steps will be executed
-
-        {steps_to_execute}
-
-        ## The following steps will be skipped
-
-        {skipped_steps}
-        """)
-
-        res = msg.format(
+        res = PLAN_VISUALIZATION_TEMPLATE.format(
             steps_to_execute='\n'.join(steps_to_execute),
             skipped_steps='\n'.join(skipped_steps),
             env_vars=env_vars_string
         )
 
-        self.logger.info(res)
+        log.info(res)
         return res
 
     def apply(self) -> None:
-
-        # Pre checks
-        for step in self.steps_to_execute:
-            # Check whether checksums are still the same (i.e. did any file content change?)
-            checksum_data: PlanStepChecksum = step.checksum
-            checksum_equal = checksum_data.test_if_checksums_equal(checksum_data.value)
-            if not checksum_equal:
-                self.logger.warning(f"😱 Checksums for step {step.name} changed. You need to re-run the plan command.")
-                return
+        import subprocess
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import datetime
+
+        # Pre checks: check whether checksums are still the same (i.e. did any file content change?)
+        # Reading and hashing files releases the GIL, so all steps are checked concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(self.steps_to_execute)))) as executor:
+            checksums_equal = list(executor.map(
+                lambda step: step.checksum.test_if_checksums_equal(step.checksum.value),
+                self.steps_to_execute,
+            ))
+        changed_steps = [step for step, checksum_equal in zip(self.steps_to_execute, checksums_equal) if not checksum_equal]
+        if changed_steps:
+            for step in changed_steps:
+                log.warning("😱 Checksums for step %s changed. You need to re-run the plan command.", step.name)
+            return
 
         # Set required environment variables
-        for env_var in self.required_env_vars:
-            env_var.apply()
+        apply_env_vars(self.required_env_vars)
+
+        already_ran = self._batch_validate([step.validation for step in self.steps_to_execute])
+        # The batch results are only stale once a step was executed after them
+        executed_since_validation = False
 
         # Execute steps
-        for step in self.steps_to_execute:
-            if step.check_if_ran():
-                self.logger.info(f'✅ Skipping step {step.name} since it already ran')
+        for step, ran in zip(self.steps_to_execute, already_ran):
+            # Steps that did not pass the validation are checked again if previous steps could have completed them
+            if ran is False and executed_since_validation:
+                ran = step.check_if_ran()
+            if ran:
+                log.info('✅ Skipping step %s since it already ran', step.name)
                 continue
 
             try:
-                self.logger.info(f'⚪️ Executing Step: {step.name}')
+                log.info('⚪️ Executing Step: %s', step.name)
                 step.run()
+                executed_since_validation = True
             except subprocess.CalledProcessError as e:
-                self.logger.error(f"🔥🔥🔥 Step {step.name} failed 🔥🔥🔥")
-                self.logger.error(e)
+                log.error("🔥🔥🔥 Step %s failed 🔥🔥🔥", step.name)
+                log.error(e)
                 break
 
             validation_passed = step.check_if_ran()
             if validation_passed is None:
-                self.logger.info(f"🟢 Step {step.name} completed but could not verify")
+                log.info("🟢 Step %s completed but could not verify", step.name)
             elif validation_passed:
-                self.logger.info(f"✅ Step {step.name} completed")
+                log.info("✅ Step %s completed", step.name)
             else:
-                self.logger.error(f"🔴 Step {step.name} not completed successfully")
+                log.error("🔴 Step %s not completed successfully", step.name)
             step.executed_at = datetime.now()
         self.save_to_file(filename=self._filename)
 
 
+    @staticmethod
+    def _batch_validate(cmds: List[Optional[str]]) -> List[Optional[bool]]:
+        """ Run the validation commands in batches, each batch in a single persistent shell. """
+        from concurrent.futures import ThreadPoolExecutor
+        if not cmds:
+            return []
+
+        # The batches run concurrently since the validation commands are independent of each other. Only a few
+        # shells are started, so most commands are run without starting a new shell for them
+        shell_count = min(MAX_VALIDATION_SHELLS, os.cpu_count() or 1)
+        batch_size = -(-len(cmds) // shell_count)
+        batches = [cmds[start:start + batch_size] for start in range(0, len(cmds), batch_size)]
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            return [result for batch_results in executor.map(check_if_steps_ran, batches) for result in batch_results]
+
     def save_to_file(self, filename: str = DEFAULT_PLAN_FILE_NAME) -> str:
-        plan = {
+        from datetime import datetime
+        plan_header = {
             'setmeup_version': self.setmeup_version,
             'generated_at': datetime.now().isoformat(),
-            'required_env_vars': [var.to_dict() for var in self.required_env_vars],
-            'steps_to_execute':[step.to_dict() for step in self.steps_to_execute],
         }
 
-        with open(filename, 'w') as file:
-            yaml.dump(plan, file, default_flow_style=False)
+        # Write to a temporary file first so an interrupted dump never leaves a plan that looks up to date
+        tmp_filename = f'{filename}.tmp'
+        if filename.endswith(JSON_PLAN_FILE_EXTENSION):
+            # Plans that are not meant to be read by humans can be stored as JSON, which is much faster to write and read
+            import json
+            plan = {
+                'fingerprint': self.fingerprint,
+                'input_files': self.input_files,
+                **plan_header,
+                'required_env_vars': [var.to_dict() for var in self.required_env_vars],
+                'steps_to_execute': [step.to_dict() for step in self.steps_to_execute],
+            }
+            with open(tmp_filename, 'w') as file:
+                json.dump(plan, file, indent=2)
+        else:
+            _register_yaml_representers()
+            # Dump the plan key by key (and step by step) so the whole plan never has to be materialized at once
+            with open(tmp_filename, 'w') as file:
+                if self.fingerprint:
+                    import json
+                    file.write(f'{FINGERPRINT_HEADER}{self.fingerprint}\n')
+                    file.write(f'{INPUT_FILES_HEADER}{json.dumps(self.input_files)}\n')
+                yaml_dump(plan_header, file, default_flow_style=False, sort_keys=False)
+                yaml_dump_sequence('required_env_vars', self.required_env_vars, file)
+                yaml_dump_sequence('steps_to_execute', self.steps_to_execute, file)
+        os.replace(tmp_filename, filename)
 
         # Store latest filename information
         self._filename = filename
@@ -1,51 +1,246 @@
 import os
+import atexit
 import logging
 import hashlib
-import subprocess
-from typing import Optional
+import functools
+import mmap
+import shlex
+import threading
+from typing import Any, Callable, IO, Iterable, List, Optional, Tuple, Union
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+
+# Bound once since it is looked up for every checksum
+_sha256 = hashlib.sha256
+
+
+@functools.lru_cache(maxsize=None)
+def _yaml_loader_and_dumper() -> Tuple[type, type]:
+    # yaml is only imported on first use to keep the CLI startup fast
+    import yaml
+
+    # Prefer the libyaml based C implementations which are considerably faster than the pure Python ones
+    if yaml.__with_libyaml__:
+        loader, base_dumper = yaml.CSafeLoader, yaml.CSafeDumper
+    else:
+        log.warning('⚠️ PyYAML was installed without libyaml, falling back to the slower pure Python YAML parser')
+        loader, base_dumper = yaml.SafeLoader, yaml.SafeDumper
+
+    # Representers are registered on a subclass so the global PyYAML dumpers are left untouched
+    class Dumper(base_dumper):
+        pass
+
+    return loader, Dumper
+
+
+def yaml_load(stream: Union[bytes, str, IO]) -> Any:
+    import yaml
+    loader, _ = _yaml_loader_and_dumper()
+    return yaml.load(stream, Loader=loader)
+
+
+def yaml_dump(data: Any, stream: IO, **kwargs) -> None:
+    import yaml
+    _, dumper = _yaml_loader_and_dumper()
+    yaml.dump(data, stream, Dumper=dumper, **kwargs)
+
+
+def yaml_add_representer(data_type: type, representer: Callable[[Any, Any], Any]) -> None:
+    _, dumper = _yaml_loader_and_dumper()
+    dumper.add_representer(data_type, representer)
+
+
+def yaml_dump_sequence(key: str, items: Iterable[Any], stream: IO) -> None:
+    """ Dump a top level sequence item by item, so only one item is rendered at a time. """
+    stream.write(f'{key}:')
+    is_empty = True
+    for item in items:
+        if is_empty:
+            stream.write('\n')
+            is_empty = False
+        yaml_dump([item], stream, default_flow_style=False, sort_keys=False)
+    if is_empty:
+        stream.write(' []\n')
 
 
 def checksum_from_file(file_path: str) -> str:
-    # Read file content
+    # A single stat both checks that the file exists and provides the cache key
     try:
-        with open(file_path, 'r') as file:
-            content = file.read()
+        stat = os.stat(file_path)
     except FileNotFoundError:
-        raise Exception(f"File '{file_path}' not found")
+        raise FileNotFoundError(f"File '{file_path}' not found") from None
 
-    # Generate SHA256 checksum
-    sha256 = hashlib.sha256(content.encode('utf-8')).hexdigest()
-    return sha256
+    # The absolute path lets different spellings of the same path share a cache entry,
+    # mtime and size are part of the cache key so that changed files get re-hashed
+    return _checksum_from_file(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
 
 
-def checksum_from_string(string: str) -> str:
-    return hashlib.sha256(string.encode('utf-8')).hexdigest()
+@functools.lru_cache(maxsize=256)
+def _checksum_from_file(file_path: str, mtime_ns: int, size: int) -> str:
+    # Stream the raw bytes into the hash instead of materializing the decoded file content
+    with open(file_path, 'rb') as file:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(file, _sha256).hexdigest()
 
+        # mmap cannot map empty files
+        if size == 0:
+            return _sha256().hexdigest()
+        # Hash the page cache in place instead of copying the file onto the heap
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _sha256(memoryview(mm)).hexdigest()
 
-def check_if_step_ran(validation_check_cmd: Optional[str]) -> Optional[bool]:
-    completed = None
-    if validation_check_cmd:
-        completed = subprocess.call(validation_check_cmd, shell=True) == 0
-    return completed
 
-
-def is_file(string: Optional[str] = None):
-    return string is not None and os.path.isfile(os.path.join(string))
+@functools.lru_cache(maxsize=256)
+def checksum_from_string(string: str) -> str:
+    return _sha256(string.encode('utf-8')).hexdigest()
 
 
-def get_file_content_or_command(script) -> str:
-    script_content = ""
-    if is_file(script):
-        # If it's a file, read its content
+def fingerprint_files(file_paths: Iterable[str]) -> str:
+    """ Fingerprint files by their location, modification time and size without reading their content. """
+    fingerprint = _sha256()
+    # Relative paths in plans are resolved against the working directory
+    fingerprint.update(os.getcwd().encode('utf-8'))
+    for file_path in file_paths:
         try:
-            with open(script, 'r') as file:
-                script_content = file.read()
+            stat = os.stat(file_path)
+            file_state = f'{os.path.realpath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}'
         except FileNotFoundError:
-            raise Exception(f"Script file '{script}' not found")
+            file_state = f'{os.path.realpath(file_path)}:missing'
+        fingerprint.update(f'\0{file_state}'.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def log_hash_backend() -> None:
+    """ Log which SHA256 implementation backs the checksums. """
+    # hashlib falls back to its builtin (scalar) implementation if it was not built against OpenSSL
+    if getattr(_sha256, '__name__', '') != 'openssl_sha256':
+        log.warning('⚠️ hashlib is not backed by OpenSSL, checksums will be computed without SHA CPU extensions')
+        return
+
+    import ssl
+    if ssl.OPENSSL_VERSION_INFO < (1, 1, 1):
+        log.warning('⚠️ %s is older than 1.1.1, checksums may not use SHA CPU extensions', ssl.OPENSSL_VERSION)
     else:
-        # If it's not a file, use the script string directly
-        script_content = script
+        log.debug('SHA256 checksums are computed using %s', ssl.OPENSSL_VERSION)
+
+
+class _PersistentShell:
+    """ A long-lived shell that runs commands without forking a new shell for each of them. """
+    RETURN_CODE_SENTINEL = '__SETMEUP_RC__='
+
+    def __init__(self) -> None:
+        import subprocess
+        self.environ = dict(os.environ)
+        # /bin/sh is the shell subprocess uses for shell=True, so commands are interpreted the same way
+        self.process = subprocess.Popen(
+            ['/bin/sh'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=self.environ,
+            text=True,
+        )
+
+    def is_usable(self) -> bool:
+        # Env variables set after the shell was started would not be visible to it
+        return self.process.poll() is None and self.environ == os.environ
+
+    # Keeps the unread return codes well below the pipe buffer size, so writing a batch cannot dead-lock
+    MAX_BATCH_SIZE = 256
+
+    def run(self, cmds: List[str]) -> List[Optional[int]]:
+        """ Run the commands one after another and return their return codes.
+
+        If the shell exits while running a command, that command yields None and the following commands are not run.
+        """
+        return_codes: List[Optional[int]] = []
+        for start in range(0, len(cmds), self.MAX_BATCH_SIZE):
+            batch = cmds[start:start + self.MAX_BATCH_SIZE]
+            try:
+                # eval inside a subshell keeps syntax errors and state changes (cd, exports, ...) from leaking into the shell
+                self.process.stdin.write(''.join(
+                    f'( eval {shlex.quote(cmd)} ) </dev/null >/dev/null 2>&1\n'
+                    f'echo {self.RETURN_CODE_SENTINEL}$?\n'
+                    for cmd in batch
+                ))
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                return return_codes
+            for line in self.process.stdout:
+                if line.startswith(self.RETURN_CODE_SENTINEL):
+                    return_codes.append(int(line[len(self.RETURN_CODE_SENTINEL):]))
+                    if len(return_codes) == start + len(batch):
+                        break
+            else:
+                # The shell exited before reporting the return code of the current command (e.g. it ran kill $$)
+                self.process.wait()
+                return return_codes + [None]
+        return return_codes
+
+    def close(self) -> None:
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # The shell already exited
+            pass
+        self.process.wait()
+
+
+# Idle shells are shared between threads, so concurrent validation checks do not block each other
+_idle_shells: List[_PersistentShell] = []
+_idle_shells_lock = threading.Lock()
+
+
+def _acquire_shell() -> _PersistentShell:
+    with _idle_shells_lock:
+        while _idle_shells:
+            shell = _idle_shells.pop()
+            if shell.is_usable():
+                return shell
+            shell.close()
+    return _PersistentShell()
+
+
+def _release_shell(shell: _PersistentShell) -> None:
+    with _idle_shells_lock:
+        _idle_shells.append(shell)
+
+
+@atexit.register
+def _close_shells() -> None:
+    with _idle_shells_lock:
+        while _idle_shells:
+            _idle_shells.pop().close()
+
+
+def check_if_step_ran(validation_check_cmd: Optional[str]) -> Optional[bool]:
+    return check_if_steps_ran([validation_check_cmd])[0]
+
+
+def check_if_steps_ran(validation_check_cmds: List[Optional[str]]) -> List[Optional[bool]]:
+    """ Run several validation checks in a single shell. Steps without a validation check yield None. """
+    cmds = [cmd for cmd in validation_check_cmds if cmd]
+    if not cmds:
+        return [None] * len(validation_check_cmds)
+
+    return_codes: List[Optional[int]] = []
+    while len(return_codes) < len(cmds):
+        shell = _acquire_shell()
+        try:
+            shell_return_codes = shell.run(cmds[len(return_codes):])
+        finally:
+            _release_shell(shell)
+        if not shell_return_codes:
+            # Not even a fresh shell could run the next command
+            shell_return_codes = [None]
+        # Commands a shell did not reach since it exited are run in a fresh shell
+        return_codes += shell_return_codes
+
+    return_codes_iter = iter(return_codes)
+    return [next(return_codes_iter) == 0 if cmd else None for cmd in validation_check_cmds]
+
+
+@functools.lru_cache(maxsize=1024)
+def is_file(string: Optional[str] = None):
+    return string is not None and os.path.isfile(string)
 
-    return script_content